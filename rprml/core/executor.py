@@ -1,7 +1,7 @@
 import numpy as np
+import torch
 from tqdm.auto import tqdm
 from ignite.engine import Events
-from ignite.metrics import Accuracy
 import numbers
 
 # We define a custom event for ignite.Engine, which will fire
@@ -25,8 +25,8 @@ class _ExecutorBase(object):
     def __init__(self, simulation, log_frequency=-1, print_frequency=1):
         """
         :simulation: A subclass of simulation.Simulation, with references to
-                to train_dl, valid_dl, optimizer, ignite trainer, ignite
-                evaluator.
+                to train_dl, train_eval_dl, valid_dl, optimizer, ignite
+                trainer and an evaluate method.
         :log_frequency: After every specified number of iterations registered
             metrics will be tracked. If not specified (or -1) then uses the
             trining dataset size of the simulation object (i.e., one log per
@@ -56,6 +56,11 @@ class _ExecutorBase(object):
         # printed.
         self._not_printable_metric_names = []  # Registered metrics for logging
         # only.
+        self.track_batch_losses = False  # If True, the training loss of every
+        # batch is logged under the 'batch_loss' key of the history.
+        self._batch_losses = None  # Preallocated on the simulation device
+        # for each call to self.run, so that no syncs happen during training.
+        self._n_batch_losses = 0
         self.__initialized = False
         # Register the default handlers.
         self._register_handlers()
@@ -124,6 +129,22 @@ class _ExecutorBase(object):
             if self.print_frequency != -1:
                 self.display_output_dict()
 
+        @self.simulation.trainer.on(Events.ITERATION_COMPLETED)
+        def store_batch_loss(engine):
+            if self._batch_losses is not None:
+                self._batch_losses[self._n_batch_losses] = engine.state.output
+                self._n_batch_losses += 1
+
+    def _flush_batch_losses(self):
+        """ Moves the batch losses stored during the last call to self.run
+        to the history. """
+        if self._batch_losses is None:
+            return
+        self._output_dict['batch_loss'] += \
+            self._batch_losses[:self._n_batch_losses].tolist()
+        self._batch_losses = None
+        self._n_batch_losses = 0
+
     def run(self, epochs: int):
         """ Runs the trainer of the current simulation configuration for the
         given number of epochs. """
@@ -151,9 +172,17 @@ class _ExecutorBase(object):
 
             self._register_display_handlers()
 
+        if self.track_batch_losses:
+            if 'batch_loss' not in self._output_dict:
+                self._output_dict['batch_loss'] = []
+            self._batch_losses = torch.empty(
+                epochs * len(simulation.train_dl), device=simulation.device)
+            self._n_batch_losses = 0
+
         try:
             simulation.trainer.run(simulation.train_dl, max_epochs=epochs)
         except KeyboardInterrupt:
+            self._flush_batch_losses()
             # Clean up if interrupted.
             if self.print_frequency != -1:
                 self._remove_display_handlers()
@@ -162,6 +191,7 @@ class _ExecutorBase(object):
                     pbar.close()
             raise
 
+        self._flush_batch_losses()
         if self.print_frequency != -1:
             self._remove_display_handlers()
             self._pbar.close()
@@ -228,24 +258,21 @@ def _compute_epoch_handler(engine, executor):
 
 
 def _compute_training_loss(engine, executor):
-    evaluator = executor.simulation.evaluator
-    evaluator.run(executor.simulation.train_dl)
-    return evaluator.state.metrics['loss']
+    simulation = executor.simulation
+    return simulation.evaluate(simulation.train_eval_dl)
 
 
 def _compute_validation_loss(engine, executor):
-    evaluator = executor.simulation.evaluator
-    evaluator.run(executor.simulation.valid_dl)
-    return evaluator.state.metrics['loss']
+    simulation = executor.simulation
+    return simulation.evaluate(simulation.valid_dl)
 
 
 def _compute_test_loss(engine, executor):
     if executor.simulation.test_dl is None:
         # Test dataset was not provided.
         return None
-    evaluator = executor.simulation.evaluator
-    evaluator.run(executor.simulation.test_dl)
-    return evaluator.state.metrics['loss']
+    simulation = executor.simulation
+    return simulation.evaluate(simulation.test_dl)
 
 
 def _compute_generalization_error(engine, executor):
@@ -262,24 +289,21 @@ def _update_optimal_iteration(engine, executor):
 
 
 def _compute_training_accuracy(engine, executor):
-    evaluator = executor.simulation.evaluator
-    evaluator.run(executor.simulation.train_dl)
-    return evaluator.state.metrics['accuracy']
+    simulation = executor.simulation
+    return simulation.evaluate(simulation.train_eval_dl, 'accuracy')
 
 
 def _compute_validation_accuracy(engine, executor):
-    evaluator = executor.simulation.evaluator
-    evaluator.run(executor.simulation.valid_dl)
-    return evaluator.state.metrics['accuracy']
+    simulation = executor.simulation
+    return simulation.evaluate(simulation.valid_dl, 'accuracy')
 
 
 def _compute_test_accuracy(engine, executor):
     if executor.simulation.test_dl is None:
         # Test dataset was not provided.
         return None
-    evaluator = executor.simulation.evaluator
-    evaluator.run(executor.simulation.test_dl)
-    return evaluator.state.metrics['accuracy']
+    simulation = executor.simulation
+    return simulation.evaluate(simulation.test_dl, 'accuracy')
 
 
 class Executor(_ExecutorBase):
@@ -322,14 +346,10 @@ class Executor(_ExecutorBase):
             _update_optimal_iteration, 'opt_iter')
 
     def register_accuracy_handlers(self):
-        """ Registers accuracy metric to the evaluator. We leave this
-        behavior optimal, since we may sometimes consider regression models.
-        """
+        """ Registers accuracy metric tracking. We leave this behavior
+        optional, since we may sometimes consider regression models. """
         # The below code can only be called once.
         if self.__accuracy_handlers_registered is False:
-            evaluator = self.simulation.evaluator
-            accuracy_metric = Accuracy()
-            accuracy_metric.attach(evaluator, 'accuracy')
             self.register_printable_metric(_compute_training_accuracy,
                                            'train_acc')
             self.register_printable_metric(_compute_validation_accuracy,
@@ -1,20 +1,214 @@
+import copy
 from dataclasses import is_dataclass
+import functools
 from itertools import cycle
 import numbers
+import os
+import queue
+import types
 from typing import List, Union
 import torch
 import torch.multiprocessing as multiprocessing
 
+from .simulation import _enable_model_reuse
 from .simulation_factory import _SimulationFactoryBase
 from ..utils.hashable_dict import HashableDict
 from ..utils.io import save_to_disk
 
 
+# Name of the environment variable, which can be used to override the
+# default torch.multiprocessing sharing strategy of the platform
+# ('file_descriptor' on linux), e.g., with 'file_system' if the limit on the
+# number of open file descriptors is reached.
+_sharing_strategy_variable = 'RPRML_SHARING_STRATEGY'
+
+
+def _set_sharing_strategy():
+    """ Sets the tensor sharing strategy of the current process if it was
+    specified via the environment variable. """
+    strategy = os.environ.get(_sharing_strategy_variable)
+    if strategy is not None:
+        multiprocessing.set_sharing_strategy(strategy)
+
+
+# The handler (Experiment.handle_simulation_output) processing the
+# simulation histories in the current worker process, or None if the
+# histories are sent back unprocessed. Set up by _worker_init.
+_handle_simulation_output = None
+
+# An exception raised while setting up the current worker process, if any.
+# Re-raised by every job of the worker, since an exception raised by a pool
+# initializer makes the pool respawn its workers indefinitely.
+_worker_init_error = None
+
+
+def _worker_init(device, handle_simulation_output):
+    """ Sets up a worker process of the pool running simulations on the
+    given device. Called once per process, rather than once per job, so that
+    the handler (and the experiment object it is bound to) is only sent
+    once to every worker. """
+    global _handle_simulation_output, _worker_init_error
+    _handle_simulation_output = handle_simulation_output
+    try:
+        # Workers send the tensors, so they need the same sharing strategy as
+        # the main process.
+        _set_sharing_strategy()
+        # Multiple simulations share the cpus of a node, so avoid
+        # oversubscribing them with intra-op threads.
+        torch.set_num_threads(1)
+        device = torch.device(device)
+        if device.type == 'cuda' and device.index is not None:
+            torch.cuda.set_device(device)
+        # Simulations of a worker are run one at a time, so the same model
+        # objects can be shared between them.
+        _enable_model_reuse()
+    except Exception as e:
+        _worker_init_error = e
+
+
 def _job(simulation_factory, seed, device, epochs):
+    """ Runs a single simulation and processes its history with the handler
+    of the worker process (if any), so that only the processed output is
+    sent back. """
+    if _worker_init_error is not None:
+        raise RuntimeError('Setting up the worker process has failed.') \
+            from _worker_init_error
     simulation = simulation_factory(seed, device)
     simulation.executor.print_frequency = -1  # Disable printing.
     simulation.run(epochs)
-    return (simulation.executor.history, seed, device)
+    output = simulation.executor.history
+    if _handle_simulation_output is not None:
+        output = _handle_simulation_output(output)
+    return (_share_output(output), seed, device)
+
+
+# Minimal length of a list of python numbers in a simulation output for it
+# to be sent through shared memory. Every shared tensor needs its own shared
+# memory segment (and file descriptor handoff), which only pays off compared
+# to pickling for long lists, such as per-batch losses of long simulations.
+_min_shared_list_length = 100000
+
+
+def _share_output(output):
+    """ If the given simulation output is a dictionary (such as a history of
+    metrics), moves its values that are long lists of python ints or floats
+    into shared memory tensors, so that they are not pickled element by
+    element when sent between processes. Tensors contained in the output
+    are moved to shared memory as well.
+
+    Returns the new output and the list of keys of the converted values.
+    The output is only copied (preserving its type) if some of its values
+    are converted.
+    """
+    if isinstance(output, torch.Tensor):
+        return output.share_memory_(), []
+    if not isinstance(output, dict):
+        return output, []
+
+    shared_output = output
+    shared_keys = []
+    for key, values in output.items():
+        if isinstance(values, torch.Tensor):
+            values.share_memory_()
+            continue
+        if not isinstance(values, list) or \
+                len(values) < _min_shared_list_length:
+            continue
+        if all(type(value) is int for value in values):
+            dtype = torch.int64
+        elif all(type(value) is float for value in values):
+            dtype = torch.float64
+        else:
+            continue
+        if shared_output is output:
+            shared_output = copy.copy(output)
+        shared_output[key] = torch.tensor(values, dtype=dtype)
+        shared_output[key].share_memory_()
+        shared_keys.append(key)
+    return shared_output, shared_keys
+
+
+def _unshare_output(shared_output, shared_keys):
+    """ Inverse of _share_output. """
+    if len(shared_keys) == 0:
+        return shared_output
+    output = copy.copy(shared_output)
+    for key in shared_keys:
+        output[key] = output[key].tolist()
+    return output
+
+
+@functools.lru_cache(maxsize=None)
+def _get_identifier_keys(cls):
+    """ Returns a tuple of field names of the dataclass cls and its dataclass
+    base classes, which are used for constructing simulation identifiers. """
+    keys = {}
+
+    def append_identifiers(cls):
+        if is_dataclass(cls):
+            keys.update(cls.__annotations__)
+            for base_cls in cls.__bases__:
+                append_identifiers(base_cls)
+
+    append_identifiers(cls)
+    return tuple(keys.keys())
+
+
+def _canonicalize(value):
+    """ Converts a simulation field value to a number or a string which does
+    not depend on the memory address of the value, so that identifiers of
+    the same simulation coincide across processes. Elements of lists,
+    tuples and dictionaries are converted recursively. """
+    if type(value) in (int, float, bool) or isinstance(value, numbers.Number):
+        return value
+    if isinstance(value, torch.device):
+        return str(value)
+    if isinstance(value, type):
+        return value.__module__ + '.' + value.__qualname__
+    if isinstance(value, functools.partial):
+        args = [str(_canonicalize(arg)) for arg in value.args]
+        args += [key + '=' + str(_canonicalize(arg))
+                 for key, arg in sorted(value.keywords.items())]
+        return _canonicalize(value.func) + '(' + ', '.join(args) + ')'
+    if isinstance(value, types.FunctionType):
+        name = value.__module__ + '.' + value.__qualname__
+        if value.__closure__:
+            # Closures (e.g., returned by models.get_mlp_factory) are told
+            # apart by the values of their free variables.
+            cells = []
+            for cell in value.__closure__:
+                try:
+                    contents = cell.cell_contents
+                except ValueError:
+                    continue  # The cell is empty.
+                if isinstance(contents, types.FunctionType):
+                    # Do not recurse into closures of (possibly recursive)
+                    # inner functions.
+                    contents = contents.__module__ + '.' + \
+                        contents.__qualname__
+                cells.append(str(_canonicalize(contents)))
+            name += '(' + ', '.join(cells) + ')'
+        return name
+    if isinstance(value, (list, tuple)):
+        items = ', '.join(str(_canonicalize(item)) for item in value)
+        if isinstance(value, tuple):
+            return '(' + items + ')'
+        return '[' + items + ']'
+    if isinstance(value, dict):
+        return '{' + ', '.join(
+            str(_canonicalize(key)) + ': ' + str(_canonicalize(item))
+            for key, item in value.items()) + '}'
+    if callable(value) and not isinstance(value, torch.nn.Module):
+        # Callable objects (e.g., models.LinearModelFactory instances) are
+        # represented by their class and the values of their attributes.
+        # Modules, such as loss functions, have address-free string
+        # representations, which are kept.
+        name = type(value).__module__ + '.' + type(value).__qualname__
+        attributes = getattr(value, '__dict__', {})
+        return name + '(' + ', '.join(
+            key + '=' + str(_canonicalize(item))
+            for key, item in sorted(attributes.items())) + ')'
+    return str(value)
 
 
 # Where the output files will be saved.
@@ -45,32 +239,37 @@ class Experiment(object):
         meant to be used by simulation objects of type core.Simulation.
         Should be independent of the simulation output. """
         # Construct relevant keys, using field names of dataclass and its
-        # subclasses recursively.
+        # subclasses recursively, and set them to the values taken by the
+        # current simulation object.
         identifier = {}
-
-        def append_identifiers(cls):
-            if is_dataclass(cls):
-                identifier.update(cls.__annotations__)
-                for base_cls in cls.__bases__:
-                    append_identifiers(base_cls)
-
-        append_identifiers(simulation.__class__)
-
-        # Update the dictionary keys to the ones taken by the current
-        # simulation object.
-        for key in identifier.keys():
-            identifier[key] = simulation.__getattribute__(key)
-            if not isinstance(identifier[key], numbers.Number):
-                identifier[key] = str(identifier[key])
+        for key in _get_identifier_keys(simulation.__class__):
+            identifier[key] = _canonicalize(getattr(simulation, key))
         if '_learning_rate' in identifier.keys():
             identifier['learning_rate'] = identifier['_learning_rate']
             del identifier['_learning_rate']
 
-        return HashableDict(identifier)
+        # Sort the keys, so that equal identifiers have equal string
+        # representations.
+        return HashableDict(sorted(identifier.items()))
+
+    def _get_schedule(self, epochs_per_simulation: Union[int, List[int]]):
+        """ Returns a list of (simulation_factory, epochs) pairs, in the order
+        in which the simulations are performed by both prototype_run and
+        full_run. If epochs_per_simulation is a list shorter than the list of
+        simulation factories, it is repeated cyclically. """
+        if isinstance(epochs_per_simulation, int):
+            epochs_per_simulation = [epochs_per_simulation]
+        return list(zip(self.simulation_factories,
+                        cycle(epochs_per_simulation)))
 
     def handle_simulation_output(self, simulation_history):
         """ Implements a default simulation output handler. Override for
-        custom behavior. """
+        custom behavior. In full_run, an overridden method is called in the
+        worker processes, hence the experiment object has to be picklable.
+        It is sent once to every worker process. Experiments of classes
+        defined in __main__ (e.g., in a notebook), which cannot be imported
+        by the worker processes, are handled in the main process instead.
+        """
         return simulation_history
 
     def prototype_run(self, seed: int, device: torch.device,
@@ -81,12 +280,9 @@ class Experiment(object):
 
         Returns a dictionary from simulation identifiers to simulation outputs.
         """
-        if isinstance(epochs_per_simulation, int):
-            epochs_per_simulation = [epochs_per_simulation]
-
         results = {}
-        for simulation_factory, epochs in zip(self.simulation_factories,
-                                              cycle(epochs_per_simulation)):
+        for simulation_factory, epochs in \
+                self._get_schedule(epochs_per_simulation):
             simulation = simulation_factory(seed, device)
             simulation.run(epochs)
             simulation_identifier = self.construct_simulation_identifier(
@@ -101,53 +297,102 @@ class Experiment(object):
         """ Runs the experiment with multiple seeds, distributing the
         simulations across different devices and saving the results to disk.
         """
-        if isinstance(epochs_per_simulation, int):
-            epochs_per_simulation = [epochs_per_simulation]
+        schedule = self._get_schedule(epochs_per_simulation)
 
-        multiprocessing.set_sharing_strategy('file_system')
+        _set_sharing_strategy()
         context = multiprocessing.get_context('spawn')
 
-        experiment_id = 0
-        for simulation_factory, epochs in zip(self.simulation_factories,
-                                              cycle(epochs_per_simulation)):
-            # Create a pool for each device.
-            pools = []
+        # Process the simulation histories in the worker processes, so that
+        # only the processed outputs are sent back, unless the handler is the
+        # default one (which returns the history as it is) or the class of
+        # the experiment cannot be unpickled by the worker processes.
+        # Unpickling errors while starting a worker would make the pool
+        # respawn its workers indefinitely.
+        worker_handler = None
+        if type(self).handle_simulation_output is not \
+                Experiment.handle_simulation_output and \
+                type(self).__module__ != '__main__':
+            worker_handler = self.handle_simulation_output
+
+        # Create a pool for each device. The pools are shared between all the
+        # simulation factories, so that worker processes (and their cuda
+        # contexts) are only set up once.
+        pools = []
+        # On failure, terminate the pools, so that they neither keep running
+        # the remaining jobs nor hold on to their cuda contexts.
+        succeeded = False
+        try:
             for device in devices_list:
-                pools.append(context.Pool(processes=n_processes_per_device))
-
-            # For each pool execute jobs.
-            results = []
-            for pool_id, (pool, device) in enumerate(zip(pools, devices_list)):
-                args = []
-                for i in range(n_runs_per_device):
-                    args.append((
-                        simulation_factory,
+                initargs = (device, worker_handler)
+                pools.append(context.Pool(processes=n_processes_per_device,
+                                          initializer=_worker_init,
+                                          initargs=initargs))
+
+            for experiment_id, (simulation_factory, epochs) in \
+                    enumerate(schedule):
+                processed_outputs = self._run_jobs(
+                    pools, devices_list, n_runs_per_device,
+                    simulation_factory, epochs, worker_handler is None)
+
+                # We create a new simulation object to get an identifier.
+                simulation_identifier = self.construct_simulation_identifier(
+                    simulation_factory(0, torch.device('cpu')))
+                # Write processed_outputs to disk.
+                file_path = _outputs_prefix + self.name + '/experiment_' + \
+                    str(experiment_id)
+                save_to_disk((simulation_identifier, processed_outputs),
+                             file_path)
+
+            succeeded = True
+        finally:
+            for pool in pools:
+                if succeeded:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+
+    def _run_jobs(self, pools, devices_list, n_runs_per_device,
+                  simulation_factory, epochs, handle_outputs):
+        """ Runs n_runs_per_device simulations of the given factory in each
+        of the given pools. If handle_outputs is True, the outputs sent back
+        by the workers are processed by self.handle_simulation_output.
+
+        Returns a list of (processed_output, seed, device) tuples ordered by
+        seed. """
+        # For each pool execute jobs. Outputs of finished jobs (or their
+        # exceptions, including failures to send the outputs back) are put
+        # into a local queue by the result handler thread of the pool,
+        # regardless of the device.
+        results_queue = queue.Queue()
+        n_jobs = 0
+        for pool_id, (pool, device) in enumerate(zip(pools, devices_list)):
+            for i in range(n_runs_per_device):
+                args = (simulation_factory,
                         pool_id * n_runs_per_device + i,  # seed,
                         device,
-                        epochs))
-                results.append(pool.starmap_async(_job, args))
-
-            # Save all runs of the current simulation configuration to disk.
-            all_outputs = []
-            for pool, result in zip(pools, results):
-                all_outputs += result.get()
-                pool.close()
-                pool.join()
+                        epochs)
+                pool.apply_async(_job, args,
+                                 callback=results_queue.put,
+                                 error_callback=results_queue.put)
+                n_jobs += 1
 
-            # Now process all the outputs to save only what we need.
-            processed_outputs = []
-            for simulation in all_outputs:
-                simulation_history, used_seed, used_device = simulation
+        # Collect the outputs in the order in which the jobs finish,
+        # processing them to save only what we need if the workers have not
+        # done so already.
+        processed_outputs = []
+        for _ in range(n_jobs):
+            output = results_queue.get()
+            if isinstance(output, BaseException):
+                raise output
+            shared_output, used_seed, used_device = output
+            processed_output = _unshare_output(*shared_output)
+            if handle_outputs:
                 processed_output = self.handle_simulation_output(
-                    simulation_history)
-                processed_outputs.append(
-                    (processed_output, used_seed, used_device))
-
-            # We create a new simulation object to get an identifier.
-            simulation_identifier = self.construct_simulation_identifier(
-                simulation_factory(0, torch.device('cpu')))
-            # Write processed_outputs to disk.
-            file_path = _outputs_prefix + self.name + '/experiment_' + \
-                str(experiment_id)
-            save_to_disk((simulation_identifier, processed_outputs), file_path)
-            experiment_id += 1
+                    processed_output)
+            processed_outputs.append(
+                (processed_output, used_seed, used_device))
+        # Save the outputs ordered by seed, independently of the order in
+        # which the jobs have finished.
+        processed_outputs.sort(key=lambda output: output[1])
+        return processed_outputs
@@ -1,35 +1,234 @@
+import inspect
 import torch
 from dataclasses import dataclass
 from typing import Callable, Union, List
-from ignite.engine import Engine, create_supervised_evaluator
-from ignite.metrics import Loss
+from ignite.engine import Engine
 from torch.utils.data.dataloader import DataLoader
 from torch.optim.lr_scheduler import _LRScheduler
 
 from .executor import Executor
 from ..data.data import dataset_factory_methods
+from ..data.data_utils import TensorDataset, TensorDataLoader
 from ..utils.random import reset_all_seeds
 
 
+def _get_fast_sgd_kwargs(device: torch.device, capturable=False):
+    """ Returns keyword arguments making torch.optim.SGD update all the
+    parameters with a single fused (on cuda) or vectorized kernel, depending
+    on what the installed pytorch version supports. If capturable is True,
+    the fused implementation is avoided so that the step can be captured
+    in a cuda graph. """
+    sgd_parameters = inspect.signature(torch.optim.SGD).parameters
+    if device.type == 'cuda' and 'fused' in sgd_parameters and \
+            not capturable:
+        return {'fused': True}
+    if 'foreach' in sgd_parameters:
+        return {'foreach': True}
+    return {}
+
+
+# Whether compiled models can be reused between simulations in the current
+# process. Only enabled in the worker processes of core.Experiment.full_run,
+# which run simulations one at a time and discard them once they are done.
+_model_reuse_enabled = False
+
+# A (key, module, compiled_model) tuple describing the model compiled by the
+# previous simulation of the current process, if reuse is enabled.
+_reusable_model = None
+
+
+def _enable_model_reuse():
+    """ Enables reusing compiled models between simulations in the current
+    process. """
+    global _model_reuse_enabled
+    _model_reuse_enabled = True
+
+
+def _set_up_model(model, device: torch.device, compile_mode):
+    """ Moves the given model to device and compiles it if compile_mode is
+    not None. If model reuse is enabled and the previous simulation compiled
+    a model of the same architecture, the weights of the given model are
+    copied into the previously compiled model, which is returned instead.
+    This avoids recompiling the model for every seed. Only the most recent
+    model is kept, so that models of other architectures are freed. """
+    global _reusable_model
+    if compile_mode is None:
+        return model.to(device)
+
+    key = None
+    if _model_reuse_enabled:
+        key = (type(model), repr(model), str(device), compile_mode)
+        if _reusable_model is not None and _reusable_model[0] == key:
+            _, module, compiled_model = _reusable_model
+            module.load_state_dict(model.state_dict())
+            return compiled_model
+        # Free the previous model before setting up the new one.
+        _reusable_model = None
+
+    module = model.to(device)
+    compiled_model = torch.compile(module, mode=compile_mode, dynamic=False)
+
+    if key is not None:
+        _reusable_model = (key, module, compiled_model)
+    return compiled_model
+
+
+def _count_correct_predictions(y_pred, y):
+    """ Returns the number of correct classifications as a tensor. """
+    if y_pred.dim() == y.dim() + 1:
+        # Multiclass classification, y_pred contains a score for each class.
+        y_pred = torch.argmax(y_pred, dim=1)
+    else:
+        # Binary classification, y_pred contains 0/1 predictions.
+        y_pred = torch.round(y_pred)
+    return torch.sum(y_pred == y)
+
+
 def _create_supervised_trainer(simulation):
     """ Creates a ignite.engine.Engine object, which reads the optimizer,
-    model and loss function information from the Simulation object. """
+    model and loss function information from the Simulation object.
+
+    The engine output is the detached loss tensor of the current batch, so
+    that training steps do not synchronize with the device. The model is
+    expected to be in training mode, which is set up once by the Simulation
+    object rather than at every iteration. """
 
     def _process_function(engine, batch):
-        simulation.model.train()
-        simulation.optimizer.zero_grad()
         X, y = batch
-        y_pred = simulation.model(X)
-        loss = simulation.loss_function(y_pred, y)
-        loss.backward()
-        simulation.optimizer.step()
+        loss = simulation._train_step(X, y)
         if simulation.lr_scheduler is not None:
             simulation.lr_scheduler.step()
-        return loss.item()
+        return loss.detach()
 
     return Engine(_process_function)
 
 
+class _CudaPrefetchLoader(object):
+    """ Wraps a data loader, copying the next batch to a cuda device on a
+    side stream while the current batch is being processed. The wrapped data
+    loader should use pinned memory, otherwise the copies are synchronous. """
+
+    def __init__(self, data_loader, device: torch.device):
+        self.data_loader = data_loader
+        self.device = device
+        self.memcpy_stream = torch.cuda.Stream(device)
+
+    def _get_next_batch(self, batches):
+        """ Starts copying the next batch to device, returns None once the
+        wrapped data loader is exhausted. """
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.memcpy_stream):
+            return [x.to(self.device, non_blocking=True) for x in batch]
+
+    def __iter__(self):
+        batches = iter(self.data_loader)
+        next_batch = self._get_next_batch(batches)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.memcpy_stream)
+            batch = next_batch
+            # The batch was allocated on the side stream, so let the caching
+            # allocator know that it is used on the current stream.
+            for x in batch:
+                x.record_stream(current_stream)
+            next_batch = self._get_next_batch(batches)
+            yield batch
+
+    def __len__(self):
+        return len(self.data_loader)
+
+
+class _CudaGraphTrainStep(object):
+    """ Performs training steps of a simulation by replaying a cuda graph
+    capturing the whole step (forward pass, loss, backward pass and
+    optimizer step), which launches all of its kernels at once.
+
+    The graph is captured after a few eager warm-up steps, on the first
+    batch of size simulation.batch_size. Batches of other shapes (e.g., the
+    last batch of an epoch) are processed eagerly. The learning rate is
+    baked into the graph, hence the graph has to be reset whenever it
+    changes. """
+
+    n_warmup_steps = 3
+
+    def __init__(self, simulation, eager_train_step: Callable):
+        """
+        :simulation: The Simulation object to be trained.
+        :eager_train_step: A function (X, y) -> loss performing a single
+            optimization step eagerly.
+        """
+        self.simulation = simulation
+        self.eager_train_step = eager_train_step
+        self.reset()
+
+    def reset(self):
+        """ Discards the captured graph, which will be recaptured after
+        another round of warm-up steps. """
+        self._graph = None
+        self._optimizer = None
+        self._n_steps = 0
+
+    def _capture(self, X, y):
+        simulation = self.simulation
+        if type(simulation.optimizer) is not torch.optim.SGD:
+            # For example, MirrorDescentOptimizer reassigns p.data in
+            # its step, which cannot be replayed.
+            raise ValueError('Capturing training steps in a cuda graph '
+                             'requires a torch.optim.SGD optimizer.')
+        self._static_X = X.clone()
+        self._static_y = y.clone()
+        self._graph = torch.cuda.CUDAGraph()
+        self._optimizer = simulation.optimizer
+        # Gradients are allocated from the graph's private memory pool.
+        simulation.optimizer.zero_grad(set_to_none=True)
+        with torch.cuda.graph(self._graph):
+            self._static_loss = simulation.loss_function(
+                simulation.model(self._static_X), self._static_y)
+            self._static_loss.backward()
+            simulation.optimizer.step()
+
+    def __call__(self, X, y):
+        simulation = self.simulation
+        if self._graph is not None and \
+                self._optimizer is not simulation.optimizer:
+            # The optimizer was replaced after the graph was captured.
+            self.reset()
+
+        if self._graph is None:
+            if simulation.device.type != 'cuda':
+                raise ValueError('use_cuda_graph requires a cuda device.')
+            if simulation.lr_scheduler is not None:
+                raise ValueError('use_cuda_graph cannot be combined with an '
+                                 'lr_scheduler.')
+            if X.shape[0] != simulation.batch_size:
+                return self.eager_train_step(X, y)
+            if self._n_steps < self.n_warmup_steps:
+                # Warm up on a side stream, as required before capturing.
+                self._n_steps += 1
+                current_stream = torch.cuda.current_stream(simulation.device)
+                warmup_stream = torch.cuda.Stream(simulation.device)
+                warmup_stream.wait_stream(current_stream)
+                with torch.cuda.stream(warmup_stream):
+                    loss = self.eager_train_step(X, y)
+                current_stream.wait_stream(warmup_stream)
+                return loss
+            self._capture(X, y)
+
+        if X.shape != self._static_X.shape or \
+                y.shape != self._static_y.shape:
+            return self.eager_train_step(X, y)
+
+        # Capturing does not execute the step, hence it is always replayed.
+        self._static_X.copy_(X)
+        self._static_y.copy_(y)
+        self._graph.replay()
+        # The output of the graph is overwritten on the next replay.
+        return self._static_loss.clone()
+
+
 @dataclass
 class Simulation(object):
     """ A class for storing configuration of the simulation to be performed
@@ -69,17 +268,49 @@ class Simulation(object):
             # Set the new learning rate.
             for group in self.optimizer.param_groups:
                 group['lr'] = val
+            if self.use_cuda_graph:
+                # The old learning rate is baked into the captured graph.
+                self._train_step.reset()
 
     # A dictionary of extra keyword arguments to be used when creating data
     # loaders and model.
     data_factory_kwargs: dict = None
     model_factory_kwargs: dict = None
 
+    # Settings of torch DataLoader objects, which are only used for datasets
+    # that are not of type TensorDataset. If num_workers is None, data is
+    # loaded in the main process. If pin_memory is None, memory is pinned
+    # whenever cpu data is used for a simulation on a cuda device.
+    num_workers: int = None
+    pin_memory: bool = None
+
+    # If not None, the model is compiled via torch.compile using the given
+    # mode (for example, 'default' or 'reduce-overhead'). Shapes are
+    # treated as static, so that kernels specialized to batch_size are
+    # reused across iterations.
+    compile_mode: str = None
+
+    # If True, training steps on batches of size batch_size are captured in a
+    # cuda graph and replayed, instead of launching their kernels one by
+    # one. Requires a cuda device, the torch.optim.SGD optimizer and no
+    # lr_scheduler.
+    use_cuda_graph: bool = False
+
     __initialized = False
 
     def __post_init__(self):
         """ A method for setting up the learner object. """
 
+        # Devices may also be given as strings, such as 'cuda:0'.
+        self.device = torch.device(self.device)
+
+        # The remaining requirements of use_cuda_graph are only checked once
+        # training starts, so that such simulations can still be set up on
+        # cpu (e.g., for constructing simulation identifiers).
+        if self.use_cuda_graph and self.compile_mode is not None:
+            raise ValueError('use_cuda_graph cannot be combined with '
+                             'compile_mode.')
+
         # Reset the seed before setting up the data and calling model factory.
         reset_all_seeds(self.seed)
 
@@ -108,27 +339,34 @@ class Simulation(object):
 
         self.train_dataset, self.valid_dataset, self.test_dataset = datasets
 
-        # Create model and move to device.
-        self.model = self.model_factory(**self.model_factory_kwargs)
-        self.model.to(self.device)
+        # Create model, move to device and compile if needed.
+        self.model = _set_up_model(
+            self.model_factory(**self.model_factory_kwargs), self.device,
+            self.compile_mode)
+        # The model stays in training mode, self.evaluate restores it after
+        # switching to evaluation mode.
+        self.model.train()
 
         # Set up the optimizer.
         self.optimizer = torch.optim.SGD(
-            self.model.parameters(), self.learning_rate, momentum=0,
-            dampening=0, weight_decay=0, nesterov=False)
+            self.model.parameters(), self.learning_rate,
+            **_get_fast_sgd_kwargs(self.device, self.use_cuda_graph))
+        if self.use_cuda_graph:
+            self._train_step = _CudaGraphTrainStep(self, self._train_step)
 
-        # Set up ignite trainer and evaluator computing the loss.
+        # Set up ignite trainer.
         self.trainer = _create_supervised_trainer(self)
-        self.evaluator = create_supervised_evaluator(
-            self.model, metrics={'loss': Loss(self.loss_function)},
-            device=self.device)
-
-        # Reset the seed again once the data and the model is set up.
-        reset_all_seeds(self.seed)
 
         self.executor = Executor(self)
 
         # Set up the data loaders before registering custom handlers.
+        # torch DataLoader objects are cached, so that their worker processes
+        # persist between the calls to self.run().
+        self._data_loaders = {}
+        # Data is shuffled using dedicated generators (one per device),
+        # seeded once here, so that the order of the training data does not
+        # depend on the global RNG state.
+        self._generators = {}
         self._reset_data_loaders()
 
         # Call the custom handlers.
@@ -140,12 +378,66 @@ class Simulation(object):
         # variables.
         self.__initialized = True
 
+    def _get_generator(self, device: torch.device):
+        """ Returns the generator used for shuffling data on the given
+        device. """
+        device = torch.device(device)
+        if device not in self._generators:
+            generator = torch.Generator(device=device)
+            generator.manual_seed(self.seed)
+            self._generators[device] = generator
+        return self._generators[device]
+
+    def _get_data_loader(self, dataset, batch_size, shuffle):
+        """ Returns a data loader for the given dataset. Datasets of type
+        TensorDataset are batched by slicing their tensors directly, without
+        going through torch DataLoader. """
+        if isinstance(dataset, TensorDataset):
+            return TensorDataLoader(
+                dataset, batch_size, shuffle,
+                generator=self._get_generator(dataset.X.device))
+
+        key = (id(dataset), batch_size, shuffle)
+        if key not in self._data_loaders:
+            num_workers = self.num_workers
+            if num_workers is None:
+                num_workers = 0
+            pin_memory = self.pin_memory
+            if pin_memory is None:
+                X, _ = dataset[0]
+                pin_memory = self.device.type == 'cuda' and \
+                    isinstance(X, torch.Tensor) and not X.is_cuda
+            kwargs = {}
+            if num_workers > 0:
+                kwargs['persistent_workers'] = True
+                kwargs['prefetch_factor'] = 2
+            if shuffle:
+                # Every iteration over a DataLoader draws a seed from its
+                # generator, so unshuffled loaders must not use the shared
+                # one, otherwise the order of the training data would depend
+                # on the number of evaluations.
+                kwargs['generator'] = self._get_generator('cpu')
+            self._data_loaders[key] = DataLoader(
+                dataset, batch_size=batch_size, shuffle=shuffle,
+                num_workers=num_workers, pin_memory=pin_memory, **kwargs)
+        return self._data_loaders[key]
+
     def _reset_data_loaders(self):
         """ Resets the data loader objects. """
-        self.train_dl = DataLoader(self.train_dataset,
-                                   batch_size=self.batch_size, shuffle=True)
-        self.valid_dl = DataLoader(self.valid_dataset,
-                                   batch_size=self.n_valid, shuffle=False)
+        self.train_dl = self._get_data_loader(
+            self.train_dataset, self.batch_size, shuffle=True)
+        if isinstance(self.train_dl, DataLoader) and \
+                self.train_dl.pin_memory and self.device.type == 'cuda':
+            # Overlap host to device copies of training batches with compute.
+            self.train_dl = _CudaPrefetchLoader(self.train_dl, self.device)
+        # Training metrics are computed in the middle of training epochs, so
+        # they use a separate unshuffled loader. Iterating self.train_dl
+        # would reset the live iterator of a DataLoader with persistent
+        # workers.
+        self.train_eval_dl = self._get_data_loader(
+            self.train_dataset, self.batch_size, shuffle=False)
+        self.valid_dl = self._get_data_loader(
+            self.valid_dataset, self.n_valid, shuffle=False)
 
         # If test dataset exists, create a test data loader.
         self.test_dl = None
@@ -155,9 +447,49 @@ class Simulation(object):
             test_batch_size = self.n_valid
             if test_batch_size > len(self.test_dataset):
                 test_batch_size = len(self.test_dataset)
-            self.test_dl = DataLoader(self.test_dataset,
-                                      batch_size=test_batch_size,
-                                      shuffle=False)
+            self.test_dl = self._get_data_loader(
+                self.test_dataset, test_batch_size, shuffle=False)
+
+    def _train_step(self, X, y):
+        """ Performs a single optimization step on the batch (X, y) and
+        returns the loss. """
+        self.optimizer.zero_grad()
+        loss = self.loss_function(self.model(X), y)
+        loss.backward()
+        self.optimizer.step()
+        return loss
+
+    def evaluate(self, data_loader, metric='loss'):
+        """ Computes the given metric of the current model on the data points
+        of the given data loader.
+
+        :data_loader: An iterable over (X, y) batches.
+        :metric: Either 'loss' or 'accuracy'. The loss is averaged over
+            the data points using self.loss_function.
+        :returns: The metric value as a python float.
+        """
+        if metric not in ('loss', 'accuracy'):
+            raise ValueError(
+                'Parameter metric has to be \"accuracy\" or \"loss\".')
+
+        was_training = self.model.training
+        self.model.eval()
+        total = 0
+        n = 0
+        with torch.inference_mode():
+            for X, y in data_loader:
+                X = X.to(self.device, non_blocking=True)
+                y = y.to(self.device, non_blocking=True)
+                y_pred = self.model(X)
+                if metric == 'loss':
+                    total += self.loss_function(y_pred, y) * len(y)
+                else:
+                    total += _count_correct_predictions(y_pred, y)
+                n += len(y)
+        self.model.train(was_training)
+
+        # Only synchronize with the device once all the batches are done.
+        return (total / n).item()
 
     def run(self, epochs: int):
         """ Runs the trainer for the given number of epochs. """
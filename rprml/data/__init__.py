@@ -1,9 +1,10 @@
 from .dataset_transforms import TransformedTensorDataset, \
     register_metric_tracking_on_transformed_dataset
-from .data_utils import TensorDataset
+from .data_utils import TensorDataset, TensorDataLoader
 
 __all__ = [
     'TensorDataset',
+    'TensorDataLoader',
     'TransformedTensorDataset',
     'register_metric_tracking_on_transformed_dataset',
 ]
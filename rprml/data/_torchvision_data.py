@@ -1,7 +1,46 @@
+import functools
 import torch
 import torchvision
 from torchvision.transforms import Compose, ToTensor, Normalize
-from .data_utils import get_preloaded_tensor_dataset, split_by_count, data_path
+from .data_utils import TensorDataset, get_preloaded_tensor_dataset, \
+    split_by_count, data_path
+
+
+_mnist_transforms = Compose([ToTensor(), Normalize((0.1307,), (0.3081,))])
+_cifar10_transforms = Compose([ToTensor()])
+
+# Test datasets do not depend on the random seed, hence they are preloaded
+# only once per process. Maps dataset classes to (X, y) tensors on cpu.
+_preloaded_test_tensors = {}
+
+
+@functools.lru_cache(maxsize=8)
+def __load_torchvision_dataset(dataset_class, transforms, train):
+    """ Loads a torchvision dataset, caching the result so that the files are
+    only read and decoded once per process. """
+    return dataset_class(download=True, root=data_path,
+                         transform=transforms, train=train)
+
+
+def __get_preloaded_test_dataset(dataset_class, transforms, device):
+    """ Returns a copy of the preloaded test dataset on the given device. """
+    if dataset_class not in _preloaded_test_tensors:
+        test_dataset = __load_torchvision_dataset(
+            dataset_class, transforms, train=False)
+        test_dataset = get_preloaded_tensor_dataset(
+            test_dataset, torch.device('cpu'))
+        _preloaded_test_tensors[dataset_class] = test_dataset.X, test_dataset.y
+
+    X, y = _preloaded_test_tensors[dataset_class]
+    if device.type == 'cuda' and not X.is_pinned():
+        # Pinned memory allows for asynchronous copies to the device.
+        X, y = X.pin_memory(), y.pin_memory()
+        _preloaded_test_tensors[dataset_class] = X, y
+
+    # Always copy, since the returned dataset may be modified in place.
+    X = X.to(device, non_blocking=True, copy=True)
+    y = y.to(device, non_blocking=True, copy=True)
+    return TensorDataset(X, y, device)
 
 
 def __get_torchvision_datasets(dataset_class, transforms, n_train, n_valid,
@@ -18,17 +57,16 @@ def __get_torchvision_datasets(dataset_class, transforms, n_train, n_valid,
 
     """
 
-    train_dataset_full = dataset_class(download=True, root=data_path,
-                                       transform=transforms, train=True)
-    test_dataset = dataset_class(download=True, root=data_path,
-                                 transform=transforms, train=False)
+    train_dataset_full = __load_torchvision_dataset(
+        dataset_class, transforms, train=True)
 
     train_dataset, valid_dataset = \
         split_by_count(train_dataset_full, n_train, n_valid)
 
     train_dataset = get_preloaded_tensor_dataset(train_dataset, device)
     valid_dataset = get_preloaded_tensor_dataset(valid_dataset, device)
-    test_dataset = get_preloaded_tensor_dataset(test_dataset, device)
+    test_dataset = __get_preloaded_test_dataset(
+        dataset_class, transforms, torch.device(device))
 
     return train_dataset, valid_dataset, test_dataset
 
@@ -45,8 +83,7 @@ def get_mnist_datasets(n_train, n_valid, device=torch.device('cpu')):
     """
 
     dataset_class = torchvision.datasets.MNIST
-    data_transform = Compose([ToTensor(), Normalize((0.1307,), (0.3081,))])
-    return __get_torchvision_datasets(dataset_class, data_transform,
+    return __get_torchvision_datasets(dataset_class, _mnist_transforms,
                                       n_train, n_valid, device)
 
 
@@ -63,6 +100,5 @@ def get_cifar10_datasets(n_train, n_valid, device=torch.device('cpu')):
     """
 
     dataset_class = torchvision.datasets.CIFAR10
-    data_transform = Compose([ToTensor()])
-    return __get_torchvision_datasets(dataset_class, data_transform,
+    return __get_torchvision_datasets(dataset_class, _cifar10_transforms,
                                       n_train, n_valid, device)
@@ -8,11 +8,13 @@ data_path = './downloaded_data'
 
 
 class TensorDataset(Dataset):
-    """ A dataset representation simply containing two tensors X and y. """
+    """ A dataset representation simply containing two tensors X and y.
+    The tensors are stored contiguously, so that batches sliced out of them
+    by TensorDataLoader are contiguous views. """
 
     def __init__(self, X, y, device: torch.device):
-        self.X = X.to(device)
-        self.y = y.to(device)
+        self.X = X.to(device).contiguous()
+        self.y = y.to(device).contiguous()
 
     def __getitem__(self, index):
         return self.X[index], self.y[index]
@@ -21,6 +23,43 @@ class TensorDataset(Dataset):
         return len(self.y)
 
 
+class TensorDataLoader(object):
+    """ A light-weight replacement of torch DataLoader for TensorDataset
+    objects. Batches are sliced directly out of the stored tensors, which
+    avoids indexing and collating the dataset one data point at a time. """
+
+    def __init__(self, dataset: TensorDataset, batch_size, shuffle=False,
+                 generator: torch.Generator = None):
+        """
+        :dataset: A TensorDataset object.
+        :batch_size: Number of data points per batch. The last batch is
+            smaller if batch_size does not divide the dataset size.
+        :shuffle: If True, the data points are reshuffled every epoch.
+        :generator: A torch.Generator on the device of the dataset, used for
+            shuffling. If None, the global RNG is used.
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = generator
+
+    def __iter__(self):
+        X, y = self.dataset.X, self.dataset.y
+        n = len(y)
+        if not self.shuffle:
+            for i in range(0, n, self.batch_size):
+                yield X[i:i + self.batch_size], y[i:i + self.batch_size]
+            return
+
+        perm = torch.randperm(n, device=X.device, generator=self.generator)
+        for i in range(0, n, self.batch_size):
+            idx = perm[i:i + self.batch_size]
+            yield X[idx], y[idx]
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+
 def get_preloaded_tensor_dataset(dataset: Dataset, device: torch.device):
     """ Preloads a given dataset object as a TensorDataset. """
     X, y = dataset[0]
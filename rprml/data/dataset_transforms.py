@@ -1,9 +1,8 @@
 import numpy as np
 import torch
 from typing import Callable
-from torch.utils.data.dataloader import DataLoader
 
-from .data_utils import TensorDataset
+from .data_utils import TensorDataset, TensorDataLoader
 from ..core.executor import Executor
 
 
@@ -62,7 +61,7 @@ def register_metric_tracking_on_transformed_dataset(
         :executor: A core.Executor object to which the handler will be
             attached.
         :dataset: A dataset of type TransformedTensorDataset which will be
-            used by the executors evaluator to compute metrics.
+            used to evaluate the metric of the executor's simulation.
         :dataset_split: Either 'clean' or 'noisy'.
         :metric: Either 'loss' or 'accuracy'.
         :handler_name: The name of the handler, which will be visible in the
@@ -70,8 +69,8 @@ def register_metric_tracking_on_transformed_dataset(
     """
 
     if metric == 'accuracy':
-        # Need to register accuracy metric tracking for the evaluator to be
-        # used by the handler defined below.
+        # Register the default accuracy metrics alongside the handler
+        # defined below.
         executor.register_accuracy_handlers()
     elif metric != 'loss':
         raise ValueError(
@@ -85,18 +84,16 @@ def register_metric_tracking_on_transformed_dataset(
         return
 
     if dataset_split == 'clean':
-        data_loader = DataLoader(clean_dataset, batch_size=len(clean_dataset))
+        data_loader = TensorDataLoader(clean_dataset, len(clean_dataset))
     elif dataset_split == 'noisy':
-        data_loader = DataLoader(noisy_dataset, batch_size=len(noisy_dataset))
+        data_loader = TensorDataLoader(noisy_dataset, len(noisy_dataset))
     else:
         raise ValueError(
             'Parameter dataset_split has to be \"clean\" or \"noisy\".')
 
     # Set up the handler tracking the desired metric.
     def handler(engine, _executor):
-        evaluator = _executor.simulation.evaluator
-        evaluator.run(data_loader)
-        return evaluator.state.metrics[metric]
+        return _executor.simulation.evaluate(data_loader, metric)
 
     # Finally, register the handler to the executor.
     executor.register_not_printable_metric(handler, handler_name)
@@ -6,8 +6,11 @@ class HashableDict(dict):
     This dictionary cannot be changed after it has been used as a key the first
     time. """
 
+    __slots__ = ('_hash',)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._hash = None
         for key, value in self.items():
             if isinstance(value, dict):
                 value = HashableDict(value)
@@ -17,4 +20,13 @@ class HashableDict(dict):
         return str(self) == str(other)
 
     def __hash__(self):
-        return hash(frozenset(self.items()))
+        # Objects pickled before the hash was cached are unpickled without
+        # calling __init__, hence the slot may be unset.
+        if getattr(self, '_hash', None) is None:
+            self._hash = hash(frozenset(self.items()))
+        return self._hash
+
+    def __reduce__(self):
+        # Do not pickle the cached hash, since hashes of strings differ
+        # between python processes.
+        return (self.__class__, (dict(self),))